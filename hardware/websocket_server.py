@@ -5,105 +5,271 @@ Receives commands from web interface and controls hardware
 """
 
 import asyncio
+import collections
+import functools
+import numpy as np
 import websockets
-import json
+import orjson
 import logging
+import re
 import time
 from typing import Dict, Any, Optional
-import serial
-import threading
+import serial_asyncio
+
+try:
+    import msgpack
+except ImportError:  # MessagePack broadcasts are optional
+    msgpack = None
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Minimum coordinate change (m) considered a real movement
+POSITION_EPSILON = 1e-4
+
+# Maximum time (s) between position broadcasts while the robot is idle
+POSITION_HEARTBEAT = 1.0
+
+# Minimum time (ns) between position broadcasts, caps the rate at 10Hz
+POSITION_MIN_INTERVAL_NS = 100_000_000
+
+# Hardware MOVE command, coordinates in meters with millimeter resolution
+_MOVE_FMT = "MOVE:{:.3f},{:.3f},{:.3f}\n".format
+
+# Payload of a hardware POS: response, e.g. b"1.5,2.0,3.0"; each coordinate
+# accepts the same decimal/exponent forms as float()
+_POS_NUM = rb"\s*([+-]?(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?)\s*"
+_POS_RE = re.compile(_POS_NUM + rb"," + _POS_NUM + rb"," + _POS_NUM)
+
+# Inbound websocket limits: largest accepted frame and per-client backlog
+MAX_MESSAGE_SIZE = 4096
+MAX_MESSAGE_QUEUE = 32
+
+# Websocket subprotocols; "msgpack" clients get binary position/status broadcasts
+SUBPROTOCOLS = ["msgpack", "json"] if msgpack else ["json"]
+
+def _response(success: bool, data: Any = None, error: Optional[str] = None) -> Dict[str, Any]:
+    """Command response fields sent back to the client"""
+    return {"success": success, "data": data, "error": error}
+
+# Plain acknowledgements carry no data, so they are shared (never mutated)
+_RESP_OK = _response(True)
+_RESP_FAIL = _response(False)
+
+class SerialProtocol(asyncio.Protocol):
+    """Delivers hardware responses line by line on the event loop"""
+    
+    def __init__(self, robot: "CableRobotController"):
+        self.robot = robot
+        self.buffer = bytearray()
+    
+    def data_received(self, data: bytes):
+        """Buffer serial data and process each complete line"""
+        self.buffer += data
+        while True:
+            end = self.buffer.find(b"\n")
+            if end < 0:
+                break
+            line = bytes(self.buffer[:end]).strip()
+            del self.buffer[:end + 1]
+            if line:
+                self.robot._process_hardware_response(line)
+    
+    def connection_lost(self, exc: Optional[Exception]):
+        """Mark hardware as disconnected"""
+        if exc:
+            logger.error(f"Error reading hardware: {exc}")
+        logger.info("Hardware connection closed")
+        self.robot._tx_ready = False
+        self.robot.serial_connection = None
+
 class CableRobotController:
     """Hardware controller for cable robot"""
+    
+    __slots__ = (
+        "simulation_mode", "serial_port", "baud_rate", "serial_connection",
+        "_pos", "_tx_ready", "is_calibrated", "emergency_stop",
+        "system_active", "on_position_change",
+        "_ws_center", "_ws_half", "_tx_queue", "_tx_flush_handle",
+        "_move_cache", "_handlers"
+    )
+    
     # Para simular sin Hardware conectado se cambiaron estas dos lineas por las dos siguientes
     #def __init__(self, serial_port: str = "COM3", baud_rate: int = 115200):
     #   self.serial_port = serial_port
     def __init__(self, serial_port=None, baud_rate: int = 115200):  # None = modo simulación
         self.simulation_mode = (serial_port is None)
     
+        self.serial_port = serial_port
         self.baud_rate = baud_rate
         self.serial_connection = None
-        self.position = {"x": 0.0, "y": 0.0, "z": 2.5}
-        self.is_connected = False
+        # Current position (m) as x, y, z; exposed as a dict by the position property
+        self._pos = np.array([0.0, 0.0, 2.5])
+        # True while commands can be written to the hardware
+        self._tx_ready = False
         self.is_calibrated = False
         self.emergency_stop = False
         self.system_active = False
-        
-        self.connect_hardware()
+        # Called on the event loop whenever the hardware reports a new position
+        self.on_position_change = None
+        # Workspace box as center and half-extents (m)
+        self._ws_center = (0.0, 0.0, 2.5)
+        self._ws_half = (2.5, 2.5, 2.0)
+        self._tx_queue = collections.deque()
+        self._tx_flush_handle = None
+        # Encoded MOVE commands keyed on the target in integer millimeters
+        self._move_cache = functools.lru_cache(maxsize=4096)(
+            lambda xi, yi, zi: _MOVE_FMT(xi / 1000, yi / 1000, zi / 1000).encode()
+        )
+        # Hardware response handlers keyed on the text before the first ":"
+        self._handlers = {
+            b"POS": self._handle_position,
+            b"STATUS": self._handle_status,
+            b"CALIBRATED": self._handle_calibrated,
+            b"ERROR": self._handle_error,
+        }
+    
+    @property
+    def is_connected(self) -> bool:
+        """Whether the hardware serial link is up"""
+        return self._tx_ready
     
-    def connect_hardware(self):
+    @property
+    def position(self) -> Dict[str, float]:
+        """Current position as a dict, built on demand for serialization"""
+        x, y, z = self._pos.tolist()
+        return {"x": x, "y": y, "z": z}
+    
+    async def connect_hardware(self):
         """Connect to hardware via serial"""
+        if self.simulation_mode:
+            logger.info("No serial port configured, running in simulation mode")
+            return
+        
         try:
-            self.serial_connection = serial.Serial(
-                port=self.serial_port,
-                baudrate=self.baud_rate,
-                timeout=1
+            # Responses are read by SerialProtocol directly on the event loop
+            transport, _ = await serial_asyncio.create_serial_connection(
+                asyncio.get_running_loop(),
+                lambda: SerialProtocol(self),
+                self.serial_port,
+                baudrate=self.baud_rate
             )
-            self.is_connected = True
+            self.serial_connection = transport
             logger.info(f"Connected to hardware on {self.serial_port}")
             
-            # Start background thread to read hardware responses
-            self.reader_thread = threading.Thread(target=self._read_hardware_responses)
-            self.reader_thread.daemon = True
-            self.reader_thread.start()
+            # Ask the USB-serial driver to skip its receive latency timer
+            try:
+                transport.serial.set_low_latency_mode(True)
+            except (AttributeError, ValueError, OSError) as e:
+                logger.debug(f"Low latency mode not available: {e}")
+            
+            self._tx_ready = True
             
         except Exception as e:
             logger.error(f"Failed to connect to hardware: {e}")
-            self.is_connected = False
+            self._tx_ready = False
     
-    def _read_hardware_responses(self):
-        """Background thread to read responses from hardware"""
-        while self.is_connected and self.serial_connection:
-            try:
-                if self.serial_connection.in_waiting > 0:
-                    response = self.serial_connection.readline().decode().strip()
-                    self._process_hardware_response(response)
-            except Exception as e:
-                logger.error(f"Error reading hardware: {e}")
-                time.sleep(0.1)
-    
-    def _process_hardware_response(self, response: str):
+    def _flush_tx_queue(self):
+        """Send all queued commands in a single write"""
+        self._tx_flush_handle = None
+        if not self._tx_queue or not self._tx_ready:
+            return
+        
+        commands = list(self._tx_queue)
+        self._tx_queue.clear()
+        try:
+            self.serial_connection.write(b"".join(commands))
+        except Exception as e:
+            logger.error(f"Error sending commands: {e}")
+            self._tx_ready = False
+            return
+        
+        # Logged here so every command, MOVE included, is recorded once written
+        for command in commands:
+            logger.info(f"Sent to hardware: {command.decode().rstrip()}")
+    
+    def _process_hardware_response(self, response: bytes):
         """Process responses from hardware"""
         try:
             # Parse hardware response (format depends on your hardware)
-            if response.startswith("POS:"):
-                # Example: "POS:1.5,2.0,3.0"
-                coords = response[4:].split(",")
-                self.position = {
-                    "x": float(coords[0]),
-                    "y": float(coords[1]),
-                    "z": float(coords[2])
-                }
-            elif response.startswith("STATUS:"):
-                # Example: "STATUS:ACTIVE" or "STATUS:EMERGENCY"
-                status = response[7:]
-                if status == "EMERGENCY":
-                    self.emergency_stop = True
-                    self.system_active = False
-                elif status == "ACTIVE":
-                    self.system_active = True
-                    self.emergency_stop = False
-            elif response.startswith("CALIBRATED"):
-                self.is_calibrated = True
-                
+            prefix, _, payload = response.partition(b":")
+            self._handlers.get(prefix, self._handle_unknown)(payload)
         except Exception as e:
             logger.error(f"Error processing hardware response: {e}")
     
-    def send_command(self, command: str) -> bool:
-        """Send command to hardware"""
-        if not self.is_connected or not self.serial_connection:
+    def _handle_position(self, payload: bytes):
+        """Update position from a POS: payload"""
+        # Example: "POS:1.5,2.0,3.0"
+        match = _POS_RE.fullmatch(payload)
+        if match is None:
+            logger.warning(f"Malformed position from hardware: {payload!r}")
+            return
+        # Scalar compares are cheaper than array math on three elements
+        x, y, z = float(match[1]), float(match[2]), float(match[3])
+        px, py, pz = self._pos.tolist()
+        if (abs(x - px) > POSITION_EPSILON or
+                abs(y - py) > POSITION_EPSILON or
+                abs(z - pz) > POSITION_EPSILON):
+            self._pos = np.array((x, y, z))
+            if self.on_position_change:
+                self.on_position_change()
+    
+    def _handle_status(self, payload: bytes):
+        """Update system state from a STATUS: payload"""
+        # Example: "STATUS:ACTIVE" or "STATUS:EMERGENCY"
+        if payload == b"EMERGENCY":
+            self.emergency_stop = True
+            self.system_active = False
+        elif payload == b"ACTIVE":
+            self.system_active = True
+            self.emergency_stop = False
+    
+    def _handle_calibrated(self, payload: bytes):
+        """Mark robot as calibrated"""
+        self.is_calibrated = True
+    
+    def _handle_error(self, payload: bytes):
+        """Log an ERROR: payload from hardware"""
+        # Example: "ERROR:Robot not calibrated"
+        logger.warning(f"Hardware error: {payload.decode(errors='replace')}")
+    
+    def _handle_unknown(self, payload: bytes):
+        """Ignore lines without a known prefix"""
+        # Informational lines such as "Movement completed" carry no state
+        pass
+    
+    def send_command(self, command: str, immediate: bool = False) -> bool:
+        """Send command to hardware
+        
+        Commands queued in the same event loop iteration are written together.
+        Immediate commands drop anything still queued and are written at once.
+        """
+        return self._send_payload(f"{command}\n".encode(), immediate)
+    
+    def _send_payload(self, payload: bytes, immediate: bool = False) -> bool:
+        """Queue (or write at once) an encoded, newline-terminated command"""
+        if not self._tx_ready:
             return False
         
+        if not immediate:
+            self._tx_queue.append(payload)
+            # Flushed on the next loop iteration, together with anything else
+            # queued in this one, without adding a timer delay
+            if self._tx_flush_handle is None:
+                self._tx_flush_handle = asyncio.get_running_loop().call_soon(
+                    self._flush_tx_queue
+                )
+            return True
+        
+        self._tx_queue.clear()
         try:
-            self.serial_connection.write(f"{command}\n".encode())
-            logger.info(f"Sent to hardware: {command}")
+            self.serial_connection.write(payload)
+            logger.info(f"Sent to hardware: {payload.decode().rstrip()}")
             return True
         except Exception as e:
             logger.error(f"Error sending command: {e}")
+            self._tx_ready = False
             return False
     
     def move_to_position(self, x: float, y: float, z: float) -> bool:
@@ -111,13 +277,15 @@ class CableRobotController:
         if self.emergency_stop or not self.system_active:
             return False
         
-        # Validate workspace limits
-        if not (-2.5 <= x <= 2.5 and -2.5 <= y <= 2.5 and 0.5 <= z <= 4.5):
+        # Validate workspace limits (written so that NaN is rejected too)
+        cx, cy, cz = self._ws_center
+        hx, hy, hz = self._ws_half
+        if not (abs(x - cx) <= hx and abs(y - cy) <= hy and abs(z - cz) <= hz):
             logger.warning(f"Position out of bounds: ({x}, {y}, {z})")
             return False
         
-        command = f"MOVE:{x:.3f},{y:.3f},{z:.3f}"
-        return self.send_command(command)
+        payload = self._move_cache(round(x * 1000), round(y * 1000), round(z * 1000))
+        return self._send_payload(payload)
     
     def activate_system(self) -> bool:
         """Activate robot system"""
@@ -136,7 +304,7 @@ class CableRobotController:
         """Emergency stop"""
         self.emergency_stop = True
         self.system_active = False
-        return self.send_command("EMERGENCY_STOP")
+        return self.send_command("EMERGENCY_STOP", immediate=True)
     
     def home_position(self) -> bool:
         """Move to home position"""
@@ -159,15 +327,39 @@ class CableRobotController:
 class WebSocketServer:
     """WebSocket server for robot communication"""
     
+    __slots__ = (
+        "host", "port", "robot", "connected_clients", "_json_clients",
+        "_msgpack_clients", "_update_event",
+        "_min_interval_ns", "_last_sent_ns", "_last_sent_position",
+        "_pending_position_flush"
+    )
+    
     def __init__(self, host: str = "localhost", port: int = 8080):
         self.host = host
         self.port = port
         self.robot = CableRobotController()
         self.connected_clients = set()
+        # Disjoint subsets of connected_clients by broadcast encoding
+        self._json_clients = set()
+        self._msgpack_clients = set()
+        
+        # Set by the robot when a new position arrives from the hardware
+        self._update_event = asyncio.Event()
+        self.robot.on_position_change = self._update_event.set
+        
+        # Position broadcast rate limiting; updates inside the interval are coalesced
+        self._min_interval_ns = POSITION_MIN_INTERVAL_NS
+        self._last_sent_ns = 0
+        self._last_sent_position = None
+        self._pending_position_flush = None
         
     async def register_client(self, websocket):
         """Register new client"""
         self.connected_clients.add(websocket)
+        if websocket.subprotocol == "msgpack":
+            self._msgpack_clients.add(websocket)
+        else:
+            self._json_clients.add(websocket)
         logger.info(f"Client connected: {websocket.remote_address}")
         
         # Send initial status
@@ -176,41 +368,102 @@ class WebSocketServer:
     async def unregister_client(self, websocket):
         """Unregister client"""
         self.connected_clients.discard(websocket)
+        self._json_clients.discard(websocket)
+        self._msgpack_clients.discard(websocket)
         logger.info(f"Client disconnected: {websocket.remote_address}")
     
+    def _status_payload(self, status: Dict[str, Any], ts: float) -> str:
+        """Serialized status update"""
+        return orjson.dumps({
+            "type": "status_update",
+            "data": status,
+            "timestamp": ts
+        }).decode()
+    
+    def _status_packed(self, status: Dict[str, Any], ts: float) -> bytes:
+        """MessagePack form of a status update"""
+        return msgpack.packb({
+            "type": "status_update",
+            "data": status,
+            "ts": ts
+        })
+    
+    def _position_payload(self, position: Dict[str, float], ts: float) -> str:
+        """Serialized position update"""
+        return orjson.dumps({
+            "type": "position_update",
+            "data": position,
+            "timestamp": ts
+        }).decode()
+    
+    def _position_packed(self, position: Dict[str, float], ts: float) -> bytes:
+        """MessagePack form of a position update, coordinates as [x, y, z]"""
+        return msgpack.packb({
+            "type": "position_update",
+            "data": [position["x"], position["y"], position["z"]],
+            "ts": ts
+        })
+    
     async def send_status_update(self, websocket=None):
         """Send status update to client(s)"""
-        status_message = {
-            "type": "status_update",
-            "data": self.robot.get_status(),
-            "timestamp": time.time()
-        }
+        status = self.robot.get_status()
+        ts = time.time()
         
         if websocket:
-            await websocket.send(json.dumps(status_message))
+            if websocket in self._msgpack_clients:
+                await websocket.send(self._status_packed(status, ts))
+            else:
+                await websocket.send(self._status_payload(status, ts))
         else:
-            # Broadcast to all clients
-            if self.connected_clients:
-                await asyncio.gather(
-                    *[client.send(json.dumps(status_message)) for client in self.connected_clients],
-                    return_exceptions=True
-                )
+            # Broadcast to all clients without a send task per client
+            websockets.broadcast(self._json_clients, self._status_payload(status, ts))
+            if self._msgpack_clients:
+                websockets.broadcast(self._msgpack_clients, self._status_packed(status, ts))
     
-    async def send_position_update(self):
-        """Send position update to all clients"""
+    async def send_position_update(self, ts: Optional[float] = None):
+        """Send position update to all clients
+        
+        ts is the message timestamp shared by everything sent in the same tick.
+        """
         if not self.connected_clients:
             return
         
-        position_message = {
-            "type": "position_update",
-            "data": self.robot.position,
-            "timestamp": time.time()
-        }
+        now = time.monotonic_ns()
+        wait_ns = self._last_sent_ns + self._min_interval_ns - now
+        if wait_ns > 0:
+            # Too soon: send whatever the latest position is once the interval ends
+            if self._pending_position_flush is None:
+                self._pending_position_flush = asyncio.get_running_loop().call_later(
+                    wait_ns / 1e9, self._flush_position_update
+                )
+            return
         
-        await asyncio.gather(
-            *[client.send(json.dumps(position_message)) for client in self.connected_clients],
-            return_exceptions=True
-        )
+        self._broadcast_position(now, ts)
+    
+    def _flush_position_update(self):
+        """Send the position update deferred by the rate limit"""
+        self._pending_position_flush = None
+        # The system may have been stopped or deactivated since it was scheduled
+        if not (self.connected_clients and self.robot.system_active):
+            return
+        # Nothing new if a send since scheduling already carried this position;
+        # heartbeats go through position_broadcaster
+        if self.robot.position == self._last_sent_position:
+            return
+        self._broadcast_position(time.monotonic_ns(), time.time())
+    
+    def _broadcast_position(self, now_ns: int, ts: Optional[float]):
+        """Send position update to all clients now and record the send time"""
+        self._last_sent_ns = now_ns
+        if ts is None:
+            ts = time.time()
+        
+        # Encoded once per tick; websockets.broadcast fans the same frame out
+        position = self.robot.position
+        self._last_sent_position = position
+        websockets.broadcast(self._json_clients, self._position_payload(position, ts))
+        if self._msgpack_clients:
+            websockets.broadcast(self._msgpack_clients, self._position_packed(position, ts))
     
     async def handle_command(self, websocket, message_data: Dict[str, Any]) -> Dict[str, Any]:
         """Handle command from client"""
@@ -224,62 +477,43 @@ class WebSocketServer:
                 x = float(data.get("x", 0))
                 y = float(data.get("y", 0))
                 z = float(data.get("z", 0))
+                # Clients get the new position from the broadcaster once
+                # the hardware reports it
                 success = self.robot.move_to_position(x, y, z)
-                
-                if success:
-                    # Send position update to all clients
-                    await asyncio.sleep(0.1)  # Wait for movement to start
-                    await self.send_position_update()
-                
-                return {
-                    "success": success,
-                    "data": {"position": self.robot.position}
-                }
+                return _response(success, {"position": self.robot.position})
             
             elif command == "activate":
                 success = self.robot.activate_system()
                 await self.send_status_update()
-                return {"success": success}
+                return _RESP_OK if success else _RESP_FAIL
             
             elif command == "deactivate":
                 success = self.robot.deactivate_system()
                 await self.send_status_update()
-                return {"success": success}
+                return _RESP_OK if success else _RESP_FAIL
             
             elif command == "emergency_stop":
                 success = self.robot.emergency_stop_command()
                 await self.send_status_update()
-                return {"success": success}
+                return _RESP_OK if success else _RESP_FAIL
             
             elif command == "home":
                 success = self.robot.home_position()
-                if success:
-                    await asyncio.sleep(0.1)
-                    await self.send_position_update()
-                return {"success": success}
+                return _RESP_OK if success else _RESP_FAIL
             
             elif command == "calibrate":
                 success = self.robot.calibrate()
-                return {"success": success}
+                return _RESP_OK if success else _RESP_FAIL
             
             elif command == "get_status":
-                return {
-                    "success": True,
-                    "data": self.robot.get_status()
-                }
+                return _response(True, self.robot.get_status())
             
             else:
-                return {
-                    "success": False,
-                    "error": f"Unknown command: {command}"
-                }
+                return _response(False, error=f"Unknown command: {command}")
         
         except Exception as e:
             logger.error(f"Error handling command {command}: {e}")
-            return {
-                "success": False,
-                "error": str(e)
-            }
+            return _response(False, error=str(e))
     
     async def handle_client(self, websocket, path):
         """Handle client connection"""
@@ -288,22 +522,17 @@ class WebSocketServer:
         try:
             async for message in websocket:
                 try:
-                    data = json.loads(message)
+                    # orjson parses text and binary frames without a copy
+                    data = orjson.loads(message)
                     
                     if data.get("type") == "command":
                         response = await self.handle_command(websocket, data)
                         
                         # Send response back to client
-                        response_message = {
-                            "id": data.get("id"),
-                            "success": response.get("success", False),
-                            "data": response.get("data"),
-                            "error": response.get("error")
-                        }
-                        
-                        await websocket.send(json.dumps(response_message))
+                        response_message = {"id": data.get("id"), **response}
+                        await websocket.send(orjson.dumps(response_message).decode())
                 
-                except json.JSONDecodeError:
+                except orjson.JSONDecodeError:
                     logger.error("Invalid JSON received")
                 except Exception as e:
                     logger.error(f"Error handling message: {e}")
@@ -317,19 +546,35 @@ class WebSocketServer:
         """Start WebSocket server"""
         logger.info(f"Starting WebSocket server on {self.host}:{self.port}")
         
+        await self.robot.connect_hardware()
+        
         # Start position update broadcaster
         asyncio.create_task(self.position_broadcaster())
         
         # Start WebSocket server
-        await websockets.serve(self.handle_client, self.host, self.port)
+        await websockets.serve(
+            self.handle_client, self.host, self.port,
+            max_size=MAX_MESSAGE_SIZE,
+            max_queue=MAX_MESSAGE_QUEUE,
+            # Messages are tiny documents, deflate only adds latency
+            compression=None,
+            subprotocols=SUBPROTOCOLS
+        )
         logger.info("WebSocket server started successfully")
     
     async def position_broadcaster(self):
-        """Periodically broadcast position updates"""
+        """Broadcast position updates when the robot moves"""
         while True:
-            await asyncio.sleep(0.1)  # 10Hz update rate
+            # Resend an unchanged position only as a liveness heartbeat
+            try:
+                await asyncio.wait_for(self._update_event.wait(), timeout=POSITION_HEARTBEAT)
+            except asyncio.TimeoutError:
+                pass
+            self._update_event.clear()
+            ts = time.time()
+            
             if self.connected_clients and self.robot.system_active:
-                await self.send_position_update()
+                await self.send_position_update(ts=ts)
 
 async def main():
     """Main function"""
@@ -348,11 +593,17 @@ async def main():
 
 if __name__ == "__main__":
     # Install required packages:
-    # pip install websockets pyserial
+    # pip install websockets pyserial pyserial-asyncio orjson numpy
     
     print("Cable Robot WebSocket Server")
     print("Installing required packages...")
-    print("pip install websockets pyserial")
+    print("pip install websockets pyserial pyserial-asyncio orjson numpy")
     print("\nStarting server...")
     
-    asyncio.run(main())
+    # uvloop is a faster event loop; it is not available on Windows
+    try:
+        import uvloop
+    except ImportError:
+        asyncio.run(main())
+    else:
+        uvloop.run(main())